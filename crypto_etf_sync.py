@@ -1,6 +1,13 @@
 import os
+import json
+import math
 import time
+import threading
+import orjson
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timezone
 from typing import Dict, Optional
 
@@ -36,122 +43,432 @@ PRICE_PROP = "Current Price"  # 你用的是 Current Price（Number）
 LAST_UPDATED_PROP = "Last Updated"  # 可选：没有就跳过
 
 
+# ---------------- HTTP sessions ----------------
+class CappedRetry(Retry):
+    """Retry-After 也封顶：服务端要求等很久时不在定时任务里干等。"""
+    MAX_RETRY_AFTER = 30
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, self.MAX_RETRY_AFTER)
+
+# 复用连接（keep-alive），避免每次请求都重新做 TCP + TLS 握手；
+# 429 / 5xx 自动指数退避重试（遵守 Retry-After，单次最多等 30s）
+def make_session(headers: Dict[str, str]) -> requests.Session:
+    retry = CappedRetry(
+        total=6,
+        backoff_factor=1.5,
+        backoff_max=30,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "POST", "PATCH"],
+        respect_retry_after_header=True,
+        raise_on_status=False,  # 重试用尽后返回最后的响应，由 raise_for_status() 报错
+    )
+    session = requests.Session()
+    session.headers.update(headers)
+    session.mount("https://", HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=8))
+    return session
+
+# CoinGecko / Yahoo：公开接口，不带 Notion token
+# 请求/响应的 JSON 统一用 orjson 编解码；Notion 的 Content-Type 已在 NOTION_HEADERS 里
+SESSION = make_session({"User-Agent": "notion-sync/1.0"})
+NOTION_SESSION = make_session(NOTION_HEADERS)
+
+def make_warm_up_session(session: requests.Session) -> requests.Session:
+    """与 session 共用同一个连接池，但不重试：预热失败就算了，不能拖住整个运行。"""
+    adapter = HTTPAdapter(max_retries=0)
+    adapter.poolmanager = session.get_adapter("https://").poolmanager
+    warm = requests.Session()
+    warm.headers.update(session.headers)
+    warm.mount("https://", adapter)
+    return warm
+
+NOTION_WARM_UP_SESSION = make_warm_up_session(NOTION_SESSION)
+
+# 并发请求线程数
+MAX_WORKERS = 8
+
+# 每个站点同时在途的请求上限，避免并发一起打过去触发限流再退避：
+# Notion 约 3 req/s；CoinGecko 免费档很容易 429
+HOST_SEMAPHORES = {
+    "notion": threading.BoundedSemaphore(3),
+    "coingecko": threading.BoundedSemaphore(1),
+    "yahoo": threading.BoundedSemaphore(4),
+}
+
+def warm_up(session: requests.Session, host: str, url: str):
+    """提前完成 DNS + TCP + TLS 握手，连接留在池里给后面的请求复用；失败无所谓。"""
+    try:
+        with HOST_SEMAPHORES[host]:
+            session.head(url, timeout=5)
+    except requests.RequestException:
+        pass
+
+
+# ---------------- Local cache ----------------
+# 表结构和标题 -> page_id 很少变化，缓存到本地，热启动时省掉这些请求
+CACHE_PATH = os.environ.get(
+    "NOTION_SYNC_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "notion-sync", "cache.json"),
+)
+SCHEMA_TTL = 24 * 3600           # 1 天
+TITLE_INDEX_TTL = 24 * 3600      # 1 天：行改名后最多一天才会按新标题找到页面
+
+
+class FileCache:
+    """
+    JSON 文件缓存：{key: {"value": ..., "expires_at": epoch}}。
+    读写失败只打印警告，不影响同步本身。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = self._load()
+
+    def _load(self) -> Dict:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"[Cache] Ignoring unreadable cache {self.path}: {e}")
+            return {}
+
+    def _save(self):
+        try:
+            dirname = os.path.dirname(self.path)
+            if dirname:  # NOTION_SYNC_CACHE 可能只是个文件名
+                os.makedirs(dirname, exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"[Cache] Failed to write {self.path}: {e}")
+
+    def get_or_fetch(self, key: str, ttl: float, fn):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry and entry.get("expires_at", 0) > time.time():
+                return entry["value"]
+
+        value = fn()
+        with self.lock:
+            self.data[key] = {"value": value, "expires_at": time.time() + ttl}
+            self._save()
+        return value
+
+    def is_fresh(self, key: str) -> bool:
+        with self.lock:
+            entry = self.data.get(key)
+            return bool(entry) and entry.get("expires_at", 0) > time.time()
+
+    def invalidate(self, key: str):
+        with self.lock:
+            if self.data.pop(key, None) is not None:
+                self._save()
+
+
+CACHE = FileCache(CACHE_PATH)
+
+
 # ---------------- CoinGecko ----------------
 def coingecko_get_prices(coin_ids, vs=VS_CURRENCY) -> Dict[str, Dict[str, float]]:
     url = "https://api.coingecko.com/api/v3/simple/price"
     params = {"ids": ",".join(coin_ids), "vs_currencies": vs}
-    headers = {"User-Agent": "notion-sync/1.0"}
-
-    for attempt in range(6):
-        r = requests.get(url, params=params, headers=headers, timeout=20)
-        if r.status_code == 429:
-            sleep_s = 2 * (attempt + 1)
-            print(f"[CoinGecko] 429 rate limited, sleep {sleep_s}s...")
-            time.sleep(sleep_s)
-            continue
-        r.raise_for_status()
-        return r.json()
 
-    raise RuntimeError("CoinGecko rate limited too many times (429).")
+    with HOST_SEMAPHORES["coingecko"]:
+        r = SESSION.get(url, params=params, timeout=20)
+    r.raise_for_status()
+    return orjson.loads(r.content)
 
 
 # ---------------- Yahoo Finance (ASX ETFs) ----------------
-def yahoo_last_price(ticker: str) -> Optional[float]:
+def yahoo_last_prices(tickers) -> Dict[str, Optional[float]]:
     """
-    ticker: e.g. 'IVV.AX'
-    Returns regularMarketPrice (AUD) if available.
+    tickers: e.g. ['IVV.AX', 'VGS.AX']
+    一次请求取回所有 ticker 的 regularMarketPrice (AUD)；取不到的为 None。
     """
-    url = f"https://query1.finance.yahoo.com/v8/finance/chart/{ticker}"
-    params = {"interval": "1m", "range": "1d", "includePrePost": "false"}
-    headers = {"User-Agent": "notion-sync/1.0"}
+    url = "https://query1.finance.yahoo.com/v7/finance/spark"
+    params = {"symbols": ",".join(tickers), "range": "1d", "interval": "1d"}
 
-    r = requests.get(url, params=params, headers=headers, timeout=20)
+    with HOST_SEMAPHORES["yahoo"]:
+        r = SESSION.get(url, params=params, timeout=20)
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
 
-    result = data.get("chart", {}).get("result")
-    err = data.get("chart", {}).get("error")
-    if err or not result:
-        return None
-
-    meta = result[0].get("meta", {})
-    price = meta.get("regularMarketPrice") or meta.get("previousClose")
-    return float(price) if price is not None else None
+    prices = {t: None for t in tickers}
+    for item in data.get("spark", {}).get("result") or []:
+        response = item.get("response") or []
+        if not response:
+            continue
+        meta = response[0].get("meta", {})
+        price = meta.get("regularMarketPrice") or meta.get("previousClose")
+        if price is not None:
+            prices[item.get("symbol")] = float(price)
+    return prices
 
 
 # ---------------- Notion helpers ----------------
 def notion_get_database_properties(database_id: str) -> Dict:
     url = f"https://api.notion.com/v1/databases/{database_id}"
-    r = requests.get(url, headers=NOTION_HEADERS, timeout=20)
+    with HOST_SEMAPHORES["notion"]:
+        r = NOTION_SESSION.get(url, timeout=20)
     r.raise_for_status()
-    return r.json().get("properties", {})
+    return orjson.loads(r.content).get("properties", {})
 
-def notion_find_page_id_by_title(database_id: str, title_value: str) -> str:
+def notion_load_title_index(database_id: str) -> Dict[str, list]:
+    """
+    一次查询整个数据库（按需翻页），返回 {Title: [page_id, 当前价格]}。
+    """
     url = f"https://api.notion.com/v1/databases/{database_id}/query"
-    payload = {
-        "filter": {
-            "property": TITLE_PROP,
-            "title": {"equals": title_value}
-        }
-    }
-    r = requests.post(url, headers=NOTION_HEADERS, json=payload, timeout=20)
-    r.raise_for_status()
-    results = r.json().get("results", [])
-    if not results:
+    payload = {"page_size": 100}
+    index = {}
+
+    while True:
+        with HOST_SEMAPHORES["notion"]:
+            r = NOTION_SESSION.post(url, data=orjson.dumps(payload), timeout=20)
+        r.raise_for_status()
+        data = orjson.loads(r.content)
+
+        for page in data.get("results", []):
+            title = page.get("properties", {}).get(TITLE_PROP, {}).get("title", [])
+            name = "".join(t.get("plain_text", "") for t in title)
+            price = page.get("properties", {}).get(PRICE_PROP, {}).get("number")
+            if name:
+                index.setdefault(name, [page["id"], price])
+
+        if not data.get("has_more"):
+            return index
+        payload["start_cursor"] = data["next_cursor"]
+
+def notion_lookup_page(index: Dict[str, list], database_id: str, title_value: str):
+    """返回 (page_id, Notion 里的当前价格或 None)。"""
+    if title_value not in index:
         raise RuntimeError(f'Notion DB({database_id}) 找不到 {TITLE_PROP} == "{title_value}" 的行')
-    return results[0]["id"]
+    return index[title_value]
 
-def notion_update_price(database_props: Dict, page_id: str, price: float):
+def price_unchanged(prev_price: Optional[float], price: float) -> bool:
+    return prev_price is not None and math.isclose(prev_price, price, rel_tol=1e-6)
+
+def cached_database_properties(database_id: str) -> Dict:
+    return CACHE.get_or_fetch(
+        f"schema:{database_id}", SCHEMA_TTL,
+        lambda: notion_get_database_properties(database_id),
+    )
+
+def cached_title_index(database_id: str, titles) -> Dict[str, list]:
+    """
+    返回 {Title: [page_id, 当前价格]}。缓存里只存 page_id；
+    价格只有本次实时查询过才有，命中缓存时为 None（不跳过 PATCH）。
+    """
+    key = f"page-ids:{database_id}"
+    live = {}
+
+    def fetch():
+        live.update(notion_load_title_index(database_id))
+        return {name: page_id for name, (page_id, _) in live.items()}
+
+    page_ids = CACHE.get_or_fetch(key, TITLE_INDEX_TTL, fetch)
+    # 新加的行不在旧缓存里：刷新一次再查（刚实时查过就不必了）
+    if not live and any(t not in page_ids for t in titles):
+        CACHE.invalidate(key)
+        page_ids = CACHE.get_or_fetch(key, TITLE_INDEX_TTL, fetch)
+
+    return {name: [page_id, live[name][1] if name in live else None]
+            for name, page_id in page_ids.items()}
+
+def notion_reads_cached(database_id: str) -> bool:
+    """表结构和 page_id 都命中缓存时，本次运行不会读这个数据库。"""
+    return CACHE.is_fresh(f"schema:{database_id}") and CACHE.is_fresh(f"page-ids:{database_id}")
+
+def invalidate_database_cache(database_id: str):
+    CACHE.invalidate(f"schema:{database_id}")
+    CACHE.invalidate(f"page-ids:{database_id}")
+
+def make_payload_builder(database_props: Dict, now_iso: str):
+    """
+    按表结构生成 price -> PATCH payload 的函数，列检查只做一次。
+    now_iso：本次同步的时间，所有行共用。
+    """
     # 校验列存在（避免 400）
     if PRICE_PROP not in database_props:
         raise RuntimeError(f"Notion 数据库缺少列: {PRICE_PROP}")
 
-    props_payload = {PRICE_PROP: {"number": price}}
-
     if LAST_UPDATED_PROP in database_props:
-        props_payload[LAST_UPDATED_PROP] = {
-            "date": {"start": datetime.now(timezone.utc).isoformat()}
-        }
+        return lambda price: {"properties": {
+            PRICE_PROP: {"number": price},
+            LAST_UPDATED_PROP: {"date": {"start": now_iso}},
+        }}
+    return lambda price: {"properties": {PRICE_PROP: {"number": price}}}
 
+def notion_update_price(make_payload, page_id: str, price: float):
     url = f"https://api.notion.com/v1/pages/{page_id}"
-    payload = {"properties": props_payload}
-    r = requests.patch(url, headers=NOTION_HEADERS, json=payload, timeout=20)
+    with HOST_SEMAPHORES["notion"]:
+        r = NOTION_SESSION.patch(url, data=orjson.dumps(make_payload(price)), timeout=20)
     if r.status_code >= 400:
         print("[Notion] Update failed:", r.status_code, r.text)
     r.raise_for_status()
 
+def is_stale_page_error(e: Exception) -> bool:
+    """400/404：页面被删、移走或不在这个库里了，多半是缓存的 page_id 过时。"""
+    response = getattr(e, "response", None)
+    return response is not None and response.status_code in (400, 404)
+
+def notion_update_prices(database_id: str, database_props: Dict, updates: Dict[str, tuple],
+                         now_iso: str, executor: ThreadPoolExecutor, on_updated):
+    """
+    updates: {Title: (page_id, price)}，每行是独立页面，在 executor 上并发 PATCH。
+    每行写成功就调用 on_updated(Title, price)，即使别的行失败也不丢。
+    某行 400/404 时实时重查一次标题索引，page_id 变了的行在本次运行内重试。
+    """
+    if not updates:
+        return
+
+    try:
+        make_payload = make_payload_builder(database_props, now_iso)
+    except RuntimeError:
+        # 列变了：缓存的表结构已过时
+        invalidate_database_cache(database_id)
+        raise
+
+    def update_row(name, page_id):
+        price = updates[name][1]
+        notion_update_price(make_payload, page_id, price)
+        on_updated(name, price)
+
+    def run(page_ids):
+        futures = {executor.submit(update_row, name, page_id): name for name, page_id in page_ids.items()}
+        wait(futures)  # 等所有行结束再报错，成功的行都能记进日志
+        return {name: fut.exception() for fut, name in futures.items() if fut.exception()}
+
+    errors = run({name: page_id for name, (page_id, _) in updates.items()})
+
+    stale = [name for name, e in errors.items() if is_stale_page_error(e)]
+    if stale:
+        invalidate_database_cache(database_id)
+        index = cached_title_index(database_id, stale)
+        retry = {
+            name: index[name][0] for name in stale
+            if name in index and index[name][0] != updates[name][0]
+        }
+        if retry:
+            print(f"[Notion] Retrying {', '.join(retry)} with refreshed page ids")
+            for name in retry:
+                del errors[name]
+            errors.update(run(retry))
+
+    if errors:
+        raise next(iter(errors.values()))
 
-def sync_crypto():
-    print("=== Sync Crypto ===")
-    db_props = notion_get_database_properties(CRYPTO_DB_ID)
 
+def fetch_crypto_prices() -> Dict[str, float]:
+    """返回 {Notion Title: price}。"""
     prices = coingecko_get_prices(list(CRYPTO.values()), VS_CURRENCY)
 
+    result = {}
     for notion_name, cg_id in CRYPTO.items():
         if cg_id not in prices or VS_CURRENCY not in prices[cg_id]:
             raise RuntimeError(f"CoinGecko 返回缺少 {cg_id}/{VS_CURRENCY}: {prices}")
+        result[notion_name] = float(prices[cg_id][VS_CURRENCY])
+    return result
 
-        price = float(prices[cg_id][VS_CURRENCY])
-        page_id = notion_find_page_id_by_title(CRYPTO_DB_ID, notion_name)
-        notion_update_price(db_props, page_id, price)
-        print(f"✅ Crypto Updated {notion_name}: {price} {VS_CURRENCY.upper()}")
-
-def sync_etfs():
-    print("=== Sync ETFs (ASX via Yahoo) ===")
-    db_props = notion_get_database_properties(ETF_DB_ID)
+def fetch_etf_prices() -> Dict[str, float]:
+    """返回 {Notion Title: price}。"""
+    prices = yahoo_last_prices(list(ETFS.values()))
 
+    result = {}
     for notion_name, ticker in ETFS.items():
-        price = yahoo_last_price(ticker)
+        price = prices.get(ticker)
         if price is None:
             raise RuntimeError(f"Yahoo 无法获取价格：{ticker}（可能代码不对或未收录）")
-
-        page_id = notion_find_page_id_by_title(ETF_DB_ID, notion_name)
-        notion_update_price(db_props, page_id, price)
-        print(f"✅ ETF Updated {notion_name} ({ticker}): {price} AUD")
+        result[notion_name] = price
+    return result
+
+def sync_prices(banner: str, database_id: str, props_fut, index_fut, prices: Dict[str, float],
+                patch_pool: ThreadPoolExecutor, describe):
+    """describe(status, Title, price) -> 日志行（不含图标）。"""
+    lines = [banner]
+    try:
+        now_iso = datetime.now(timezone.utc).isoformat()
+        db_props, index = props_fut.result(), index_fut.result()
+
+        updates = {}
+        for notion_name, price in prices.items():
+            page_id, prev_price = notion_lookup_page(index, database_id, notion_name)
+            if price_unchanged(prev_price, price):
+                lines.append(f"⏭️ {describe('unchanged', notion_name, price)}")
+                continue
+            updates[notion_name] = (page_id, price)
+
+        notion_update_prices(
+            database_id, db_props, updates, now_iso, patch_pool,
+            lambda name, price: lines.append(f"✅ {describe('Updated', name, price)}"),
+        )
+    finally:
+        # 两个数据库并行同步，整段一次性输出，日志不会交错；失败时已写成功的行照样输出
+        print("\n".join(lines))
+
+def sync_crypto(props_fut, index_fut, prices: Dict[str, float], patch_pool: ThreadPoolExecutor):
+    sync_prices(
+        "=== Sync Crypto ===", CRYPTO_DB_ID, props_fut, index_fut, prices, patch_pool,
+        lambda status, name, price: f"Crypto {status} {name}: {price} {VS_CURRENCY.upper()}",
+    )
+
+def sync_etfs(props_fut, index_fut, prices: Dict[str, float], patch_pool: ThreadPoolExecutor):
+    sync_prices(
+        "=== Sync ETFs (ASX via Yahoo) ===", ETF_DB_ID, props_fut, index_fut, prices, patch_pool,
+        lambda status, name, price: f"ETF {status} {name} ({ETFS[name]}): {price} AUD",
+    )
+
+
+# (日志标签, 数据库, Title -> 代码, 取价函数, 同步函数)
+SYNCS = [
+    ("Crypto", CRYPTO_DB_ID, CRYPTO, fetch_crypto_prices, sync_crypto),
+    ("ETF", ETF_DB_ID, ETFS, fetch_etf_prices, sync_etfs),
+]
 
 def main():
-    sync_crypto()
-    sync_etfs()
+    errors = []
+    # 所有数据库的 PATCH 共用一个线程池，经同一组 keep-alive 连接发出
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as fetch_pool, \
+            ThreadPoolExecutor(max_workers=len(SYNCS)) as update_pool, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as patch_pool:
+        # 有实时读请求时它们自己会建好连接；全部命中缓存时第一次访问 Notion
+        # 是行情回来之后的 PATCH（索引来自缓存，每行都会 PATCH），先把握手做掉
+        if all(notion_reads_cached(database_id) for _, database_id, _, _, _ in SYNCS):
+            fetch_pool.submit(warm_up, NOTION_WARM_UP_SESSION, "notion", "https://api.notion.com/v1/users/me")
+
+        # 生产者：行情、表结构、标题索引全部同时发出
+        price_futs = {}
+        for label, database_id, rows, fetch_prices, sync in SYNCS:
+            props_fut = fetch_pool.submit(cached_database_properties, database_id)
+            index_fut = fetch_pool.submit(cached_title_index, database_id, rows)
+            price_futs[fetch_pool.submit(fetch_prices)] = (label, sync, props_fut, index_fut)
+
+        # 消费者：哪路行情先到就先派发它的 Notion 更新，不等另一路
+        jobs = {}
+        for fut in as_completed(price_futs):
+            label, sync, props_fut, index_fut = price_futs[fut]
+            try:
+                prices = fut.result()
+            except Exception as e:
+                print(f"[{label}] Price fetch failed: {e}")
+                errors.append(e)
+                continue
+            jobs[update_pool.submit(sync, props_fut, index_fut, prices, patch_pool)] = label
+
+        for job, label in jobs.items():
+            try:
+                job.result()
+            except Exception as e:
+                print(f"[{label}] Sync failed: {e}")
+                errors.append(e)
+
+    if errors:
+        raise errors[0]
     print("🎉 All done.")
 
 if __name__ == "__main__":